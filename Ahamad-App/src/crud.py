@@ -2,12 +2,16 @@ import base64
 import hashlib
 import os
 import re
+import threading
 import logging
 from datetime import datetime
 from tinydb import TinyDB, Query
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 from PIL import Image
 from roles import get_role, Role  # Import the role management module
+import security
+from journal import Journal, AtomicJSONStorage
+import stats
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', filename='app.log')
@@ -16,14 +20,50 @@ logger = logging.getLogger(__name__)
 # Paths
 DATA_PATH = 'data/'
 THUMBNAIL_PATH = os.path.join(DATA_PATH, 'thumbnails')
+JOURNAL_PATH = os.path.join(DATA_PATH, 'journal.log')
 
 # Initialize TinyDB databases
-lyrics_db = TinyDB(os.path.join(DATA_PATH, 'lyrics.json'))
+lyrics_db = TinyDB(os.path.join(DATA_PATH, 'lyrics.json'), storage=AtomicJSONStorage)
 
-# Encryption key (in a real application, store this securely)
-with open('secret.key', 'rb') as key_file:
-    encryption_key = key_file.read()
-cipher_suite = Fernet(encryption_key)
+# Write-ahead journal, opened by the first write
+journal = Journal(JOURNAL_PATH)
+
+# Highest artefact ID allocated per database, so IDs are never reused
+last_artefact_ids = {}
+artefact_id_lock = threading.Lock()
+
+# Encryption keys (in a real application, store these securely)
+KEY_PATH = security.KEY_PATH
+cipher_suite = None
+current_key_version = None
+keyring_stamp = None
+
+def get_keyring_stamp():
+    """Identify the current keyring file, which is replaced whenever keys change."""
+    key_stat = os.stat(KEY_PATH)
+    return key_stat.st_ino, key_stat.st_mtime_ns, key_stat.st_size
+
+def load_keys():
+    """
+    Load the keyring and rebuild the cipher suite.
+
+    The newest key encrypts new data; every key in the keyring can decrypt.
+    """
+    global cipher_suite, current_key_version, keyring_stamp
+    keyring_stamp = get_keyring_stamp()
+    keyring = security.load_keyring(KEY_PATH)
+    cipher_suite = MultiFernet([Fernet(key) for _, key in keyring])
+    current_key_version = keyring[0][0]
+    logger.info("Loaded %d encryption keys, current version: %d", len(keyring), current_key_version)
+
+load_keys()
+
+def refresh_keys():
+    """
+    Reload the keyring if another process has changed it since it was loaded.
+    """
+    if get_keyring_stamp() != keyring_stamp:
+        load_keys()
 
 def validate_input(input_str):
     """
@@ -87,6 +127,9 @@ def encrypt(data):
     Returns:
         str: The encrypted data.
     """
+    # Writes encrypt under the journal lock, so a rotation that has added or
+    # retired keys is always seen here before anything is written
+    refresh_keys()
     encrypted_data = cipher_suite.encrypt(data.encode('utf-8'))
     return base64.urlsafe_b64encode(encrypted_data).decode('utf-8')
 
@@ -101,20 +144,55 @@ def decrypt(data):
         str: The decrypted data.
     """
     encrypted_data = base64.urlsafe_b64decode(data.encode('utf-8'))
-    return cipher_suite.decrypt(encrypted_data).decode('utf-8')
+    try:
+        return cipher_suite.decrypt(encrypted_data).decode('utf-8')
+    except InvalidToken:
+        # The data may use a key added by a key rotation since the keyring was loaded
+        load_keys()
+        return cipher_suite.decrypt(encrypted_data).decode('utf-8')
 
-def create_artefact(db, artefact, user, role):
+def reencrypt(data):
     """
-    Create a new artefact in the database.
+    Re-encrypt the data with the current key.
+
+    Args:
+        data (str): The encrypted data to re-encrypt.
+
+    Returns:
+        str: The data encrypted with the current key.
+    """
+    encrypted_data = base64.urlsafe_b64decode(data.encode('utf-8'))
+    return base64.urlsafe_b64encode(cipher_suite.rotate(encrypted_data)).decode('utf-8')
+
+def next_artefact_id(db):
+    """
+    Allocate the next artefact ID, above every ID in the database or allocated before.
+
+    Call this while holding the journal lock, so no other process allocates the same ID.
+
+    Args:
+        db (TinyDB): The database the artefact will be inserted into.
+
+    Returns:
+        int: The new artefact ID.
+    """
+    with artefact_id_lock:
+        highest = max((max(artefact.doc_id, artefact.get('id', 0)) for artefact in db.all()), default=0)
+        artefact_id = max(highest, last_artefact_ids.get(db.storage.path, 0)) + 1
+        last_artefact_ids[db.storage.path] = artefact_id
+        return artefact_id
+
+def prepare_artefact(artefact, user, role):
+    """
+    Validate and stamp a new artefact before it is written.
 
     Args:
-        db (TinyDB): The database to insert the artefact into.
         artefact (dict): The artefact data.
         user (str): The user creating the artefact.
         role (str): The role of the user.
 
-    Returns:
-        int: The ID of the created artefact.
+    Raises:
+        PermissionError: If the user is not authorized to create artefacts.
     """
     role_instance = validate_role(role)
     if not role_instance.can_create():
@@ -124,19 +202,50 @@ def create_artefact(db, artefact, user, role):
     try:
         artefact['title'] = validate_input(artefact['title'])
         artefact['content'] = validate_input(artefact['content'])
-        artefact['content'] = encrypt(artefact['content'])
-        artefact_id = len(db) + 1
-        artefact['id'] = artefact_id
         artefact['created_at'] = datetime.now().isoformat()
         artefact['created_by'] = user
-        artefact['checksum'] = calculate_checksum(artefact['content'])
-        db.insert(artefact)
-        logger.info("Artefact created with ID: %d by user: %s", artefact_id, user)
-        return artefact_id
     except ValueError as e:
         logger.error("Failed to create artefact: %s", str(e))
         raise ValueError("Failed to create artefact: %s" % str(e)) from e
 
+def seal_artefact(db, artefact):
+    """
+    Encrypt a prepared artefact and give it an ID, under the journal lock.
+
+    Args:
+        db (TinyDB): The database the artefact will be inserted into.
+        artefact (dict): The prepared artefact.
+
+    Returns:
+        int: The ID of the artefact.
+    """
+    artefact['content'] = encrypt(artefact['content'])
+    artefact['key_version'] = current_key_version
+    artefact['checksum'] = calculate_checksum(artefact['content'])
+    artefact['id'] = next_artefact_id(db)
+    return artefact['id']
+
+def create_artefact(db, artefact, user, role):
+    """
+    Create a new artefact in the database.
+
+    Args:
+        db (TinyDB): The database to insert the artefact into.
+        artefact (dict): The artefact data.
+        user (str): The user creating the artefact.
+        role (str): The role of the user.
+
+    Returns:
+        int: The ID of the created artefact.
+    """
+    prepare_artefact(artefact, user, role)
+    with journal.transaction() as txn:
+        artefact_id = seal_artefact(db, artefact)
+        txn.insert(db, artefact_id, artefact)
+        stats.count_create(txn, db, artefact)
+    logger.info("Artefact created with ID: %d by user: %s", artefact_id, user)
+    return artefact_id
+
 def read_artefacts(db, user, role):
     """
     Read all artefacts from the database.
@@ -169,6 +278,39 @@ def read_artefacts(db, user, role):
         logger.error("Failed to read artefacts: %s", str(e))
         raise Exception("Failed to read artefacts: %s" % str(e)) from e
 
+def read_stats(db, user, role, since=None, until=None, rebuild=False):
+    """
+    Read the artefact statistics of a database without decrypting any content.
+
+    Args:
+        db (TinyDB): The database to read the statistics of.
+        user (str): The user reading the statistics.
+        role (str): The role of the user.
+        since (str): The first creation day to count, formatted as YYYY-MM-DD.
+        until (str): The last creation day to count, formatted as YYYY-MM-DD.
+        rebuild (bool): Recompute the counters from the artefacts first, admin only.
+
+    Returns:
+        dict: The number of artefacts in the category, per creator and per day.
+
+    Raises:
+        PermissionError: If the user is not authorized to read or rebuild the statistics.
+    """
+    role_instance = validate_role(role)
+    if not role_instance.can_read():
+        logger.error("User %s with role %s is not authorized to read statistics", user, role)
+        raise PermissionError("User not authorized to read statistics")
+
+    if rebuild:
+        if role != 'admin':
+            logger.error("User %s with role %s is not authorized to rebuild statistics", user, role)
+            raise PermissionError("User not authorized to rebuild statistics")
+        with journal.transaction() as txn:
+            stats.rebuild(txn, db)
+    summary = stats.summarize(db, since=since, until=until)
+    logger.info("Statistics for category %s read by user: %s", summary['category'], user)
+    return summary
+
 def update_artefact(db, artefact_id, updated_artefact, user, role):
     """
     Update an artefact in the database.
@@ -192,10 +334,17 @@ def update_artefact(db, artefact_id, updated_artefact, user, role):
     try:
         updated_artefact['title'] = validate_input(updated_artefact['title'])
         updated_artefact['content'] = validate_input(updated_artefact['content'])
-        updated_artefact['content'] = encrypt(updated_artefact['content'])
-        updated_artefact['modified_at'] = datetime.now().isoformat()
-        updated_artefact['checksum'] = calculate_checksum(updated_artefact['content'])
-        db.update(updated_artefact, Query().id == artefact_id)
+        with journal.transaction() as txn:
+            updated_artefact['content'] = encrypt(updated_artefact['content'])
+            updated_artefact['key_version'] = current_key_version
+            updated_artefact['modified_at'] = datetime.now().isoformat()
+            updated_artefact['checksum'] = calculate_checksum(updated_artefact['content'])
+            # Count the artefact as it is now, in case another writer changed it
+            txn.wait_for_applied()
+            current = db.get(doc_id=artefact.doc_id)
+            if current is not None:
+                txn.update(db, artefact.doc_id, updated_artefact)
+                stats.count_update(txn, db, current, {**current, **updated_artefact})
         logger.info("Artefact with ID %d updated by user: %s", artefact_id, user)
     except ValueError as e:
         logger.error("Failed to update artefact: %s", str(e))
@@ -221,12 +370,49 @@ def delete_artefact(db, artefact_id, user, role):
         raise PermissionError("User not authorized to delete this artefact")
 
     try:
-        db.remove(Query().id == artefact_id)
+        with journal.transaction() as txn:
+            # Only uncount the artefact if another writer has not deleted it already
+            txn.wait_for_applied()
+            current = db.get(doc_id=artefact.doc_id)
+            if current is not None:
+                txn.remove(db, artefact.doc_id)
+                stats.count_delete(txn, db, current)
         logger.info("Artefact with ID %d deleted by user: %s", artefact_id, user)
     except Exception as e:
         logger.error("Failed to delete artefact: %s", str(e))
         raise Exception("Failed to delete artefact: %s" % str(e)) from e
 
+def get_thumbnail_paths(category, artefact_id):
+    """
+    Get the temporary and final thumbnail paths for the artefact.
+
+    Args:
+        category (str): The category of the artefact.
+        artefact_id (int): The ID of the artefact.
+
+    Returns:
+        tuple: The temporary path and the thumbnail path.
+    """
+    thumbnail_dir = os.path.join(THUMBNAIL_PATH, category)
+    os.makedirs(thumbnail_dir, exist_ok=True)
+    thumbnail_path = os.path.join(thumbnail_dir, f'{artefact_id}.png')
+    return thumbnail_path + '.tmp', thumbnail_path
+
+def write_thumbnail(image_path, path):
+    """
+    Write a thumbnail of the image and flush it to disk.
+
+    Args:
+        image_path (str): The path to the image file.
+        path (str): The path to write the thumbnail to.
+    """
+    image = Image.open(image_path)
+    image.thumbnail((128, 128))
+    with open(path, 'wb') as thumbnail_file:
+        image.save(thumbnail_file, format='PNG')
+        thumbnail_file.flush()
+        os.fsync(thumbnail_file.fileno())
+
 def save_thumbnail(image_path, category, artefact_id):
     """
     Save a thumbnail for the artefact.
@@ -240,13 +426,9 @@ def save_thumbnail(image_path, category, artefact_id):
         Exception: If there is an error saving the thumbnail.
     """
     try:
-        thumbnail_dir = os.path.join(THUMBNAIL_PATH, category)
-        os.makedirs(thumbnail_dir, exist_ok=True)
-
-        image = Image.open(image_path)
-        image.thumbnail((128, 128))
-        thumbnail_path = os.path.join(thumbnail_dir, f'{artefact_id}.png')
-        image.save(thumbnail_path)
+        tmp_path, thumbnail_path = get_thumbnail_paths(category, artefact_id)
+        write_thumbnail(image_path, tmp_path)
+        os.replace(tmp_path, thumbnail_path)
         logger.info("Thumbnail saved for artefact ID %d", artefact_id)
     except Exception as e:
         logger.error("Failed to save thumbnail: %s", str(e))
@@ -256,6 +438,9 @@ def create_artefact_with_thumbnail(db, artefact, image_path, category, user, rol
     """
     Create an artefact with an associated thumbnail.
 
+    The artefact and its thumbnail are written in one journal transaction,
+    so a crash never leaves an artefact without its thumbnail.
+
     Args:
         db (TinyDB): The database to insert the artefact into.
         artefact (dict): The artefact data.
@@ -268,9 +453,15 @@ def create_artefact_with_thumbnail(db, artefact, image_path, category, user, rol
         int: The ID of the created artefact.
     """
     try:
-        artefact_id = create_artefact(db, artefact, user, role)
+        prepare_artefact(artefact, user, role)
+        with journal.transaction() as txn:
+            artefact_id = seal_artefact(db, artefact)
+            tmp_path, thumbnail_path = get_thumbnail_paths(category, artefact_id)
+            txn.rename(tmp_path, thumbnail_path)
+            write_thumbnail(image_path, tmp_path)
+            txn.insert(db, artefact_id, artefact)
+            stats.count_create(txn, db, artefact)
         if artefact_id is not None:
-            save_thumbnail(image_path, category, artefact_id)
             logger.info("Artefact with ID %d created with thumbnail by user: %s", artefact_id, user)
             return artefact_id
         else:
@@ -0,0 +1,462 @@
+"""Module for write-ahead journaling of database writes and their file side effects."""
+import fcntl
+import json
+import os
+import stat
+import tempfile
+import threading
+import uuid
+import logging
+from contextlib import contextmanager
+from tinydb import TinyDB, Query
+from tinydb.table import Document
+from tinydb.storages import Storage
+
+logger = logging.getLogger(__name__)
+
+def fsync_path(path):
+    """
+    Flush a file or directory to disk.
+
+    Args:
+        path (str): The path to flush.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Directories holding renames that are not yet flushed to disk. While a journal
+# holds its lock, renames are made durable together at its next checkpoint
+# instead of one directory fsync per write; until then the journal can redo them.
+_directory_lock = threading.Lock()
+_deferring = 0
+_unsynced_directories = set()
+
+def sync_directory(directory):
+    """
+    Make the renames in a directory durable, or defer it to the next journal checkpoint.
+
+    Args:
+        directory (str): The directory to flush.
+    """
+    with _directory_lock:
+        if _deferring:
+            _unsynced_directories.add(directory)
+            return
+    fsync_path(directory)
+
+def sync_directories():
+    """Flush every directory with deferred renames to disk."""
+    with _directory_lock:
+        directories = list(_unsynced_directories)
+        _unsynced_directories.clear()
+    for directory in directories:
+        fsync_path(directory)
+
+def _defer_directory_syncs(deferring):
+    global _deferring
+    with _directory_lock:
+        _deferring += 1 if deferring else -1
+
+class AtomicJSONStorage(Storage):
+    """TinyDB JSON storage that replaces the file atomically on every write."""
+    def __init__(self, path, create_dirs=False, encoding=None, **kwargs):
+        self.path = path
+        self.encoding = encoding
+        self.kwargs = kwargs
+        if create_dirs:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if not os.path.exists(path):
+            open(path, 'a', encoding=encoding).close()
+
+    def read(self):
+        with open(self.path, 'r', encoding=self.encoding) as db_file:
+            content = db_file.read()
+        if not content:
+            return None
+        return json.loads(content)
+
+    def write(self, data):
+        # Write a temporary file next to the database, flush it to disk and
+        # rename it over the original, so a crash never leaves a truncated database
+        directory = os.path.dirname(self.path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding=self.encoding) as db_file:
+                json.dump(data, db_file, **self.kwargs)
+                db_file.flush()
+                os.fsync(db_file.fileno())
+            # mkstemp creates the file readable by its owner only, keep the database's mode
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(self.path).st_mode))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        sync_directory(directory)
+
+    def close(self):
+        pass
+
+# Functions folding journaled data into a document, by name
+_folds = {}
+
+def register_fold(name, fold):
+    """
+    Register a function that folds journaled data into a document.
+
+    The function is called as ``fold(document, data, txn, applied)`` with a
+    copy of the document matching the operation's key (None if there is
+    none), the logged data and the transaction ID. ``applied(other_txn)``
+    tells whether another transaction was logged at or after this one in the
+    journal being replayed, so a fold that is not idempotent by itself can
+    skip a record it already includes. It returns the new document, or None
+    to leave the document unchanged.
+
+    Args:
+        name (str): The name operations refer to the function by.
+        fold (callable): The function.
+    """
+    _folds[name] = fold
+
+class Transaction:
+    """The operations of one journal transaction, written as a single redo record."""
+    def __init__(self, journal):
+        self.journal = journal
+        self.txn = uuid.uuid4().hex
+        self.ops = []
+        self.databases = {}
+
+    def _add(self, op, db, **fields):
+        self.databases[db.storage.path] = db
+        self.ops.append(dict(op=op, db=db.storage.path, **fields))
+
+    def insert(self, db, doc_id, data):
+        """Insert a document with the given document ID."""
+        self._add('insert', db, doc_id=doc_id, data=data)
+
+    def update(self, db, doc_id, data):
+        """Update the fields of a document."""
+        self._add('update', db, doc_id=doc_id, data=data)
+
+    def remove(self, db, doc_id):
+        """Remove a document."""
+        self._add('remove', db, doc_id=doc_id)
+
+    def fold(self, db, key, name, data):
+        """
+        Fold data into the document matching key with a registered fold, creating it if needed.
+
+        Args:
+            db (TinyDB): The database holding the document.
+            key (dict): The fields identifying the document.
+            name (str): The name of the fold, see ``register_fold``.
+            data: The JSON data to fold in.
+        """
+        self._add('fold', db, key=key, fold=name, data=data)
+
+    def wait_for_applied(self):
+        """Wait until every transaction logged before this one is applied."""
+        self.journal._wait_for_applied()
+
+    def rename(self, tmp_path, path):
+        """Move a file written to a temporary path into place."""
+        self.ops.append({'op': 'rename', 'src': tmp_path, 'dst': path})
+
+    def record(self):
+        return {'txn': self.txn, 'ops': self.ops}
+
+class Journal:
+    """
+    Write-ahead journal for artefact writes and the files they produce.
+
+    A transaction is logged as one redo record, made durable with a single
+    fsync, then applied. Applying a record twice has no further effect.
+    Threads committing at the same time share that fsync (group commit) and
+    apply their records in journal order.
+
+    Inserts, updates, removes and renames check the current state, so
+    applying them again has no effect. Folds registered with
+    ``register_fold`` are told which transactions replay has already
+    passed, so they can skip a record they already include.
+
+    Writers hold an exclusive flock on the journal across processes. While
+    it is held, the directory fsyncs that make applied writes durable are
+    deferred. When the last writer in the process is done, a checkpoint
+    flushes those directories once and truncates the journal, so a journal
+    that is not empty when the lock is taken was left by a crashed writer
+    and is replayed first. The truncation itself is not fsynced: if it is
+    lost in a crash, the records are replayed again with no further effect.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._holders = 0
+        self._holder_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._transaction_lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._apply_turn = threading.Condition()
+        self._appended = 0
+        self._durable = 0
+        self._syncing = False
+        self._next_apply = 1
+        self._failed = False
+        self._recovered = 0
+        self._databases = {}
+
+    def _acquire(self):
+        """Take the journal lock, recovering first if a crashed writer left records behind."""
+        with self._holder_lock:
+            if self._holders == 0:
+                if self._file is None:
+                    self._file = open(self.path, 'a', encoding='utf-8')
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+                _defer_directory_syncs(True)
+                try:
+                    self._recovered = self._recover() if os.path.getsize(self.path) else 0
+                except BaseException:
+                    _defer_directory_syncs(False)
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+                    raise
+            self._holders += 1
+
+    def _release(self):
+        """Release the journal lock, checkpointing first if every record was applied."""
+        with self._holder_lock:
+            self._holders -= 1
+            if self._holders == 0:
+                try:
+                    if self._failed:
+                        # Leave the records for the next writer to replay
+                        self._failed = False
+                    else:
+                        self._checkpoint()
+                finally:
+                    _defer_directory_syncs(False)
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def lock(self):
+        """
+        Hold the journal lock for writes made outside the journal.
+
+        Excludes writers in other processes. A truncation that was not yet
+        flushed is made durable first, so a crash cannot replay old records
+        over these writes.
+        """
+        self._acquire()
+        try:
+            os.fsync(self._file.fileno())
+            yield
+        finally:
+            self._release()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Collect operations and commit them when the block exits.
+
+        The block runs under the journal lock, and one block at a time runs
+        in the process until its record is logged, so checks made in the
+        block still hold when the record is applied. Records logged by
+        earlier blocks may not be applied yet; call
+        ``Transaction.wait_for_applied`` before reading what they change.
+        Files written for ``Transaction.rename`` should be flushed to disk
+        before the block exits. If the block raises, nothing is logged or
+        applied and the temporary files are removed.
+
+        Yields:
+            Transaction: The transaction to add operations to.
+        """
+        self._acquire()
+        try:
+            with self._transaction_lock:
+                txn = Transaction(self)
+                try:
+                    yield txn
+                except BaseException:
+                    self._discard(txn.ops)
+                    raise
+                sequence = self._log(txn) if txn.ops else None
+            # Later blocks run while this record waits for the shared fsync
+            if sequence is not None:
+                self._commit(txn, sequence)
+        finally:
+            self._release()
+
+    def _log(self, txn):
+        """Append a transaction to the journal and return its sequence number."""
+        with self._lock:
+            self._file.write(json.dumps(txn.record()) + '\n')
+            self._appended += 1
+            return self._appended
+
+    def _wait_for_applied(self):
+        """Wait until every record logged so far is applied."""
+        with self._lock:
+            sequence = self._appended
+        with self._apply_turn:
+            while self._next_apply <= sequence:
+                self._apply_turn.wait()
+
+    def _commit(self, txn, sequence):
+        """Wait until a logged transaction is durable and apply it in journal order."""
+        synced = False
+        try:
+            self._sync(sequence)
+            synced = True
+        except BaseException:
+            self._failed = True
+            raise
+        finally:
+            with self._apply_turn:
+                while self._next_apply != sequence:
+                    self._apply_turn.wait()
+                try:
+                    if synced:
+                        self._apply(txn.record(), txn.databases)
+                except BaseException:
+                    self._failed = True
+                    logger.error("Journal transaction %s failed", txn.txn)
+                    raise
+                finally:
+                    self._next_apply += 1
+                    self._apply_turn.notify_all()
+
+    def _sync(self, sequence):
+        """
+        Wait until the record with the given sequence number is durable.
+
+        The first waiter flushes and fsyncs on behalf of every record appended
+        so far; records appended during that fsync are covered by the next one.
+        """
+        with self._lock:
+            while self._durable < sequence:
+                if self._syncing:
+                    self._synced.wait()
+                    continue
+                self._syncing = True
+                target = self._appended
+                try:
+                    self._file.flush()
+                    self._lock.release()
+                    try:
+                        os.fsync(self._file.fileno())
+                    finally:
+                        self._lock.acquire()
+                    self._durable = target
+                finally:
+                    self._syncing = False
+                    self._synced.notify_all()
+
+    def _database(self, path, databases):
+        """Get an open database by path."""
+        if path in databases:
+            return databases[path]
+        if path not in self._databases:
+            self._databases[path] = TinyDB(path, storage=AtomicJSONStorage)
+        return self._databases[path]
+
+    def _apply(self, record, databases, order=None):
+        """
+        Apply a redo record. Applying it again has no further effect.
+
+        During recovery, order maps the transactions in the journal to their position.
+        """
+        for op in record['ops']:
+            if op['op'] == 'rename':
+                if os.path.exists(op['src']):
+                    os.replace(op['src'], op['dst'])
+                    sync_directory(os.path.dirname(op['dst']) or '.')
+                continue
+            if not os.path.exists(op['db']):
+                logger.warning("Skipping journal operation for missing database: %s", op['db'])
+                continue
+            db = self._database(op['db'], databases)
+            if op['op'] == 'fold':
+                self._fold(db, op, record['txn'], order)
+                continue
+            exists = db.contains(doc_id=op['doc_id'])
+            if op['op'] == 'insert' and not exists:
+                db.insert(Document(op['data'], doc_id=op['doc_id']))
+            elif op['op'] == 'update' and exists:
+                db.update(op['data'], doc_ids=[op['doc_id']])
+            elif op['op'] == 'remove' and exists:
+                db.remove(doc_ids=[op['doc_id']])
+
+    def _fold(self, db, op, txn, order):
+        """Fold logged data into a document with its registered fold."""
+        if op['fold'] not in _folds:
+            logger.error("Unknown journal fold: %s", op['fold'])
+            raise ValueError("Unknown journal fold: %s" % op['fold'])
+        condition = Query().fragment(op['key'])
+        document = db.get(condition)
+
+        def applied(other_txn):
+            return order is not None and other_txn in order and order[other_txn] >= order[txn]
+
+        folded = _folds[op['fold']](dict(document) if document is not None else None, op['data'], txn, applied)
+        if folded is not None:
+            db.upsert({**folded, **op['key']}, condition)
+
+    def _discard(self, ops):
+        """Remove the temporary files of an abandoned transaction."""
+        for op in ops:
+            if op['op'] == 'rename' and os.path.exists(op['src']):
+                os.remove(op['src'])
+
+    def _read_records(self):
+        """Read the journal records, ignoring a torn final record."""
+        records = []
+        with open(self.path, 'r', encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError("Missing end of record")
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Ignoring incomplete journal record")
+                    break
+        return records
+
+    def _checkpoint(self):
+        """Flush the applied writes to disk and empty the journal."""
+        self._file.flush()
+        sync_directories()
+        if os.path.getsize(self.path):
+            self._file.truncate(0)
+
+    def _recover(self):
+        """Replay the records left by a crashed writer, in journal order."""
+        records = self._read_records()
+        order = {record['txn']: position for position, record in enumerate(records)}
+        for record in records:
+            self._apply(record, {}, order)
+        self._checkpoint()
+        logger.info("Journal recovery replayed %d transactions", len(records))
+        return len(records)
+
+    def recover(self):
+        """
+        Replay the transactions left in the journal by a crashed writer.
+
+        Waits for writers in other processes to finish first.
+
+        Returns:
+            int: The number of transactions replayed.
+        """
+        self._acquire()
+        try:
+            return self._recovered
+        finally:
+            self._release()
+
+    def close(self):
+        """Close the journal file."""
+        with self._holder_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -1,7 +1,10 @@
 import argparse
 import logging
+from datetime import datetime
 from tinydb import TinyDB
 import crud
+import rotation
+from journal import AtomicJSONStorage
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', filename='app.log')
@@ -9,7 +12,25 @@ logger = logging.getLogger(__name__)
 
 # Paths
 DATA_PATH = 'data/'
-lyrics_db = TinyDB(f"{DATA_PATH}lyrics.json")
+lyrics_db = TinyDB(f"{DATA_PATH}lyrics.json", storage=AtomicJSONStorage)
+
+def parse_day(value):
+    """
+    Parse a day argument into the YYYY-MM-DD form the statistics are keyed by.
+
+    Args:
+        value (str): The day, e.g. 2024-06-01 or 2024-6-1.
+
+    Returns:
+        str: The day, formatted as YYYY-MM-DD.
+
+    Raises:
+        argparse.ArgumentTypeError: If the value is not a valid day.
+    """
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError as e:
+        raise argparse.ArgumentTypeError("Invalid day '%s', expected YYYY-MM-DD" % value) from e
 
 def create_artefact(args):
     """
@@ -60,6 +81,28 @@ def delete_artefact(args):
     crud.delete_artefact(lyrics_db, args.id, args.user, args.role)
     logger.info("Deleted artefact with ID: %d", args.id)
 
+def show_stats(args):
+    """
+    Show artefact statistics.
+
+    Args:
+        args (argparse.Namespace): Command-line arguments containing user, role, date range and rebuild flag.
+    """
+    summary = crud.read_stats(lyrics_db, args.user, args.role, since=args.since, until=args.until,
+                              rebuild=args.rebuild)
+    print(summary)
+
+def rotate_key(args):
+    """
+    Rotate the encryption key and re-encrypt all artefacts.
+
+    Args:
+        args (argparse.Namespace): Command-line arguments containing user, role, batch size, workers and retire flag.
+    """
+    rotated = rotation.rotate_key(lyrics_db, args.user, args.role, batch_size=args.batch_size,
+                                  workers=args.workers, retire_old_keys=args.retire_old_keys)
+    logger.info("Re-encrypted %d artefacts with the new key", rotated)
+
 def main():
     """
     Main function to handle command-line arguments and execute corresponding functions.
@@ -97,8 +140,30 @@ def main():
     delete_parser.add_argument('--role', required=True, help='Role of the user deleting the artefact')
     delete_parser.set_defaults(func=delete_artefact)
 
+    # Statistics command
+    stats_parser = subparsers.add_parser('stats', help='Show artefact counts per creator and per day')
+    stats_parser.add_argument('--user', required=True, help='User reading the statistics')
+    stats_parser.add_argument('--role', required=True, help='Role of the user reading the statistics')
+    stats_parser.add_argument('--since', type=parse_day, help='First creation day to count (YYYY-MM-DD)')
+    stats_parser.add_argument('--until', type=parse_day, help='Last creation day to count (YYYY-MM-DD)')
+    stats_parser.add_argument('--rebuild', action='store_true', help='Recompute the statistics from all artefacts first (admin only)')
+    stats_parser.set_defaults(func=show_stats)
+
+    # Rotate key command
+    rotate_parser = subparsers.add_parser('rotate-key', help='Rotate the encryption key and re-encrypt all artefacts')
+    rotate_parser.add_argument('--user', required=True, help='User rotating the key')
+    rotate_parser.add_argument('--role', required=True, help='Role of the user rotating the key')
+    rotate_parser.add_argument('--batch-size', type=int, default=rotation.DEFAULT_BATCH_SIZE, help='Number of artefacts written per batch')
+    rotate_parser.add_argument('--workers', type=int, default=rotation.DEFAULT_WORKERS, help='Number of threads re-encrypting each batch')
+    rotate_parser.add_argument('--retire-old-keys', action='store_true', help='Remove old keys from the keyring once all artefacts are re-encrypted')
+    rotate_parser.set_defaults(func=rotate_key)
+
     args = parser.parse_args()
     try:
+        # Replay writes a crashed process left half-applied before any command reads them
+        recovered = crud.journal.recover()
+        if recovered:
+            logger.info("Recovered %d journal transactions", recovered)
         args.func(args)
     except AttributeError:
         parser.print_help()
@@ -0,0 +1,152 @@
+"""Module for rotating the encryption key and re-encrypting stored artefacts."""
+import json
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import crud
+import security
+
+logger = logging.getLogger(__name__)
+
+# Paths
+CHECKPOINT_PATH = os.path.join(crud.DATA_PATH, 'rotation_checkpoint.json')
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_WORKERS = 4
+
+def load_checkpoint(checkpoint_path=CHECKPOINT_PATH):
+    """
+    Load the checkpoint of an interrupted key rotation.
+
+    Args:
+        checkpoint_path (str): The path to the checkpoint file.
+
+    Returns:
+        dict: The checkpoint, or None if no rotation is in progress.
+    """
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r', encoding='utf-8') as checkpoint_file:
+        return json.load(checkpoint_file)
+
+def save_checkpoint(checkpoint, checkpoint_path=CHECKPOINT_PATH):
+    """
+    Atomically write the key rotation checkpoint.
+
+    Args:
+        checkpoint (dict): The checkpoint to save.
+        checkpoint_path (str): The path to the checkpoint file.
+    """
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(tmp_path, checkpoint_path)
+
+def _rotate_pending(db, executor, checkpoint, checkpoint_path, batch_size):
+    """
+    Re-encrypt the artefacts after the checkpoint that are not on its key version.
+
+    Returns:
+        int: The number of artefacts rewritten.
+    """
+    key_version = checkpoint['key_version']
+    pending = sorted((artefact for artefact in db.all()
+                      if artefact.doc_id > checkpoint['last_doc_id']
+                      and artefact.get('key_version') != key_version),
+                     key=lambda artefact: artefact.doc_id)
+    rotated = 0
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        contents = [artefact['content'] for artefact in batch]
+        rotated_contents = dict(zip(contents, executor.map(crud.reencrypt, contents)))
+        rewritten = []
+
+        def apply_rotation(artefact):
+            # Artefacts updated since they were read keep their newer content
+            if artefact['content'] in rotated_contents:
+                artefact['content'] = rotated_contents[artefact['content']]
+                artefact['checksum'] = crud.calculate_checksum(artefact['content'])
+                artefact['key_version'] = key_version
+                rewritten.append(artefact['id'])
+
+        # Exclude journaled writers, and replay any a crashed writer left behind, first
+        with crud.journal.lock():
+            db.update(apply_rotation, doc_ids=[artefact.doc_id for artefact in batch])
+        rotated += len(rewritten)
+        checkpoint['last_doc_id'] = batch[-1].doc_id
+        checkpoint['rotated'] += len(rewritten)
+        save_checkpoint(checkpoint, checkpoint_path)
+        logger.info("Re-encrypted %d of %d artefacts with key version %d", rotated, len(pending), key_version)
+    return rotated
+
+def rotate_key(db, user, role, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS,
+               checkpoint_path=CHECKPOINT_PATH, retire_old_keys=False):
+    """
+    Add a new encryption key and re-encrypt all artefacts with it.
+
+    Artefacts are re-encrypted in parallel batches, each batch is written with a
+    single database update and progress is checkpointed after every batch, so an
+    interrupted rotation resumes with the same key instead of adding another one.
+    Old keys stay in the keyring until the rotation completes, so reads keep
+    working while it runs. They are only retired once every artefact is
+    verified to be on the new key.
+
+    Args:
+        db (TinyDB): The database to re-encrypt.
+        user (str): The user rotating the key.
+        role (str): The role of the user.
+        batch_size (int): The number of artefacts written per batch.
+        workers (int): The number of worker threads re-encrypting a batch.
+        checkpoint_path (str): The path to the checkpoint file.
+        retire_old_keys (bool): Remove the old keys from the keyring once done.
+
+    Returns:
+        int: The number of artefacts re-encrypted.
+
+    Raises:
+        PermissionError: If the user is not authorized to rotate the key.
+        Exception: If old keys should be retired but artefacts still use them.
+    """
+    crud.validate_role(role)
+    if role != 'admin':
+        logger.error("User %s with role %s is not authorized to rotate the encryption key", user, role)
+        raise PermissionError("User not authorized to rotate the encryption key")
+
+    checkpoint = load_checkpoint(checkpoint_path)
+    key_versions = [version for version, _ in security.load_keyring(crud.KEY_PATH)]
+    if checkpoint is not None and checkpoint['key_version'] in key_versions:
+        logger.info("Resuming rotation to key version %d after artefact %d",
+                    checkpoint['key_version'], checkpoint['last_doc_id'])
+    else:
+        checkpoint = {
+            'key_version': security.add_key(crud.KEY_PATH),
+            'last_doc_id': 0,
+            'rotated': 0
+        }
+        save_checkpoint(checkpoint, checkpoint_path)
+        logger.info("Added encryption key version %d by user: %s", checkpoint['key_version'], user)
+    crud.load_keys()
+    key_version = checkpoint['key_version']
+
+    rotated = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        rotated += _rotate_pending(db, executor, checkpoint, checkpoint_path, batch_size)
+        # Catch up with artefacts written with an old key while the first pass ran
+        checkpoint['last_doc_id'] = 0
+        rotated += _rotate_pending(db, executor, checkpoint, checkpoint_path, batch_size)
+
+    if retire_old_keys:
+        with crud.journal.lock():
+            stale = [artefact.doc_id for artefact in db.all() if artefact.get('key_version') != key_version]
+            if stale:
+                logger.error("Not retiring old keys: %d artefacts still use them", len(stale))
+                raise Exception("Cannot retire old keys: %d artefacts are not on key version %d, "
+                                "run rotate-key again" % (len(stale), key_version))
+            security.retire_keys(key_version, crud.KEY_PATH)
+            crud.load_keys()
+        logger.info("Retired encryption keys older than version %d", key_version)
+    os.remove(checkpoint_path)
+    logger.info("Key rotation to version %d completed by user: %s", key_version, user)
+    return rotated
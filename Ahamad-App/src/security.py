@@ -1,10 +1,84 @@
+"""Module for managing the versioned encryption keyring."""
+import os
 from cryptography.fernet import Fernet
 
-# Generate the encryption key
-encryption_key = Fernet.generate_key()
+# Keyring file, one "version:key" entry per line (in a real application, store this securely)
+KEY_PATH = 'secret.key'
 
-# Save the encryption key to a file
-with open('secret.key', 'wb') as key_file:
-    key_file.write(encryption_key)
+def load_keyring(path=KEY_PATH):
+    """
+    Load the encryption keys from the keyring file.
 
-print("Encryption key generated and saved to 'secret.key'")
\ No newline at end of file
+    Args:
+        path (str): The path to the keyring file.
+
+    Returns:
+        list: (version, key) tuples ordered from newest to oldest.
+    """
+    with open(path, 'rb') as key_file:
+        lines = [line.strip() for line in key_file.read().splitlines() if line.strip()]
+    keyring = []
+    for line in lines:
+        if b':' in line:
+            version, key = line.split(b':', 1)
+            keyring.append((int(version), key))
+        else:
+            # Single raw key written before keys were versioned
+            keyring.append((1, line))
+    keyring.sort(key=lambda entry: entry[0], reverse=True)
+    return keyring
+
+def save_keyring(keyring, path=KEY_PATH):
+    """
+    Atomically write the keyring file.
+
+    Args:
+        keyring (list): (version, key) tuples ordered from newest to oldest.
+        path (str): The path to the keyring file.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as key_file:
+        for version, key in keyring:
+            key_file.write(b'%d:%s\n' % (version, key))
+        key_file.flush()
+        os.fsync(key_file.fileno())
+    os.replace(tmp_path, path)
+
+def add_key(path=KEY_PATH):
+    """
+    Generate a new primary key, keeping the older keys for decryption.
+
+    Args:
+        path (str): The path to the keyring file.
+
+    Returns:
+        int: The version of the new key.
+    """
+    keyring = load_keyring(path) if os.path.exists(path) else []
+    version = keyring[0][0] + 1 if keyring else 1
+    keyring.insert(0, (version, Fernet.generate_key()))
+    save_keyring(keyring, path)
+    return version
+
+def retire_keys(keep_version, path=KEY_PATH):
+    """
+    Remove every key except the given version from the keyring.
+
+    Args:
+        keep_version (int): The key version to keep.
+        path (str): The path to the keyring file.
+
+    Raises:
+        ValueError: If the version is not in the keyring.
+    """
+    keyring = [entry for entry in load_keyring(path) if entry[0] == keep_version]
+    if not keyring:
+        raise ValueError("Unknown key version: %d" % keep_version)
+    save_keyring(keyring, path)
+
+if __name__ == "__main__":
+    new_version = add_key()
+    if new_version == 1:
+        print("Encryption key generated and saved to '%s'" % KEY_PATH)
+    else:
+        print("Encryption key version %d added to '%s'" % (new_version, KEY_PATH))
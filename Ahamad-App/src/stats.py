@@ -0,0 +1,282 @@
+"""Module for materialized artefact statistics."""
+import os
+import threading
+import logging
+from tinydb import TinyDB, Query
+import journal
+from journal import AtomicJSONStorage
+
+logger = logging.getLogger(__name__)
+
+# Counters are stored in a small file next to the category databases,
+# so reading them never parses the artefacts
+STATS_FILE = 'stats.json'
+
+# Name of the journal fold that applies counter changes
+COUNTERS_FOLD = 'stats.counters'
+
+_stats_dbs = {}
+_stats_dbs_lock = threading.Lock()
+
+def get_category(db):
+    """
+    Get the category of a database from its file name, e.g. 'lyrics'.
+
+    Args:
+        db (TinyDB): The category database.
+
+    Returns:
+        str: The category name.
+    """
+    return os.path.splitext(os.path.basename(db.storage.path))[0]
+
+def get_stats_db(db):
+    """
+    Get the statistics database next to a category database.
+
+    Args:
+        db (TinyDB): The category database.
+
+    Returns:
+        TinyDB: The statistics database.
+    """
+    path = os.path.join(os.path.dirname(db.storage.path), STATS_FILE)
+    with _stats_dbs_lock:
+        if path not in _stats_dbs:
+            _stats_dbs[path] = TinyDB(path, storage=AtomicJSONStorage)
+        return _stats_dbs[path]
+
+def get_day(created_at):
+    """
+    Get the day bucket of a creation timestamp.
+
+    Args:
+        created_at (str): The ISO creation timestamp.
+
+    Returns:
+        str: The day, formatted as YYYY-MM-DD.
+    """
+    return created_at[:10]
+
+def empty_counters(category):
+    """
+    Create an empty set of counters for a category.
+
+    Args:
+        category (str): The category name.
+
+    Returns:
+        dict: The counters.
+    """
+    return {
+        'category': category,
+        'total': 0,
+        'by_creator': {},
+        'by_day': {},
+        'by_creator_day': {}
+    }
+
+def get_deltas(artefact, delta):
+    """
+    Get the counter changes for adding or removing an artefact.
+
+    Args:
+        artefact (dict): The artefact.
+        delta (int): 1 to count the artefact, -1 to uncount it.
+
+    Returns:
+        list: (field path, delta) pairs.
+    """
+    creator = artefact['created_by']
+    day = get_day(artefact['created_at'])
+    return [
+        (['total'], delta),
+        (['by_creator', creator], delta),
+        (['by_day', day], delta),
+        (['by_creator_day', creator, day], delta)
+    ]
+
+def load_counters(db):
+    """
+    Load the counters of a category database.
+
+    Args:
+        db (TinyDB): The category database.
+
+    Returns:
+        dict: The counters.
+    """
+    category = get_category(db)
+    counters = empty_counters(category)
+    counters.update(get_stats_db(db).get(Query().category == category) or {})
+    return counters
+
+def build_counters(db):
+    """
+    Count the artefacts of a category database.
+
+    Only the creator and creation time are read; content is never decrypted.
+
+    Args:
+        db (TinyDB): The category database.
+
+    Returns:
+        dict: The counters.
+    """
+    counters = empty_counters(get_category(db))
+    for artefact in db.all():
+        for path, delta in get_deltas(artefact, 1):
+            add_count(counters, path, delta)
+    return counters
+
+def add_count(counters, path, delta):
+    """
+    Add to a counter, dropping nested counters and groups that reach zero.
+
+    Args:
+        counters (dict): The counters to change.
+        path (list): The nested keys of the counter.
+        delta (int): The amount to add.
+    """
+    parents = [counters]
+    for field in path[:-1]:
+        parents.append(parents[-1].setdefault(field, {}))
+    parents[-1][path[-1]] = parents[-1].get(path[-1], 0) + delta
+    for depth in range(len(path) - 1, 0, -1):
+        if parents[depth].get(path[depth]) in (0, {}):
+            del parents[depth][path[depth]]
+
+def fold_counters(counters, data, txn, applied):
+    """
+    Apply logged counter changes to the stored counters of a category.
+
+    Increments are not idempotent, so the counters remember the last
+    transaction applied to them and a replayed record they include is skipped.
+
+    Args:
+        counters (dict): The stored counters, or None if there are none.
+        data (dict): Counters to start from, or None, and the (path, delta) changes.
+        txn (str): The ID of the transaction being applied.
+        applied (callable): Tells whether a transaction was logged at or after this one.
+
+    Returns:
+        dict: The new counters, or None if they already include the changes.
+    """
+    if counters is not None and applied(counters.get('_txn')):
+        return None
+    if data['counters'] is not None:
+        counters = dict(data['counters'])
+    counters = counters if counters is not None else {}
+    for path, delta in data['deltas']:
+        add_count(counters, path, delta)
+    counters['_txn'] = txn
+    return counters
+
+journal.register_fold(COUNTERS_FOLD, fold_counters)
+
+def _count(txn, db, deltas):
+    """Log counter changes in a journal transaction."""
+    stats_db = get_stats_db(db)
+    category = get_category(db)
+    counters = None
+    if not stats_db.contains(Query().category == category):
+        # Artefacts written before the counters existed are counted first,
+        # once every transaction logged before this one is applied
+        txn.wait_for_applied()
+        if not stats_db.contains(Query().category == category):
+            counters = build_counters(db)
+    txn.fold(stats_db, {'category': category}, COUNTERS_FOLD,
+             {'counters': counters, 'deltas': [[list(path), delta] for path, delta in deltas]})
+
+def count_create(txn, db, artefact):
+    """
+    Count a created artefact as part of a journal transaction.
+
+    Args:
+        txn (Transaction): The transaction creating the artefact.
+        db (TinyDB): The category database.
+        artefact (dict): The created artefact.
+    """
+    _count(txn, db, get_deltas(artefact, 1))
+
+def count_update(txn, db, before, after):
+    """
+    Move an updated artefact between counters if its creator or creation day changed.
+
+    Args:
+        txn (Transaction): The transaction updating the artefact.
+        db (TinyDB): The category database.
+        before (dict): The artefact before the update.
+        after (dict): The artefact after the update.
+    """
+    if (before['created_by'], get_day(before['created_at'])) == (after['created_by'], get_day(after['created_at'])):
+        return
+    _count(txn, db, get_deltas(before, -1) + get_deltas(after, 1))
+
+def count_delete(txn, db, artefact):
+    """
+    Uncount a deleted artefact as part of a journal transaction.
+
+    Args:
+        txn (Transaction): The transaction deleting the artefact.
+        db (TinyDB): The category database.
+        artefact (dict): The deleted artefact.
+    """
+    _count(txn, db, get_deltas(artefact, -1))
+
+def rebuild(txn, db):
+    """
+    Recompute the counters of a category database from its artefacts.
+
+    The counters are replaced with a single write when the transaction is applied.
+
+    Args:
+        txn (Transaction): The transaction replacing the counters.
+        db (TinyDB): The category database.
+
+    Returns:
+        dict: The rebuilt counters.
+    """
+    txn.wait_for_applied()
+    counters = build_counters(db)
+    txn.fold(get_stats_db(db), {'category': counters['category']}, COUNTERS_FOLD,
+             {'counters': counters, 'deltas': []})
+    logger.info("Rebuilt statistics for category %s: %d artefacts", counters['category'], counters['total'])
+    return counters
+
+def summarize(db, since=None, until=None):
+    """
+    Summarize the counters of a category database, optionally for a range of days.
+
+    Args:
+        db (TinyDB): The category database.
+        since (str): The first day to count, formatted as YYYY-MM-DD.
+        until (str): The last day to count, formatted as YYYY-MM-DD.
+
+    Returns:
+        dict: The category, the number of artefacts and the counts per creator and per day.
+    """
+    counters = load_counters(db)
+    if since is None and until is None:
+        return {
+            'category': counters['category'],
+            'total': counters['total'],
+            'by_creator': dict(counters['by_creator']),
+            'by_day': dict(counters['by_day'])
+        }
+
+    def in_range(day):
+        return (since is None or day >= since) and (until is None or day <= until)
+
+    by_day = {day: count for day, count in counters['by_day'].items() if in_range(day)}
+    by_creator = {}
+    for creator, days in counters['by_creator_day'].items():
+        count = sum(count for day, count in days.items() if in_range(day))
+        if count:
+            by_creator[creator] = count
+    return {
+        'category': counters['category'],
+        'total': sum(by_day.values()),
+        'by_creator': by_creator,
+        'by_day': by_day
+    }
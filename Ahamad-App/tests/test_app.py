@@ -1,13 +1,24 @@
+import argparse
 import hashlib
+import json
 import shutil
+import stat
 import sys
 import os
+import threading
+import time
 from datetime import datetime
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
 
 import unittest
+from unittest import mock
 from tinydb import TinyDB, Query
 import crud
+import journal
+import main
+import rotation
+import security
+import stats
 import logging
 
 # Configure logging
@@ -27,7 +38,11 @@ class TestApp(unittest.TestCase):
         cls.test_data_path = 'test_data/'
         if not os.path.exists(cls.test_data_path):
             os.makedirs(cls.test_data_path)
-        cls.lyrics_db = TinyDB(os.path.join(cls.test_data_path, 'lyrics.json'))
+        cls.lyrics_db = TinyDB(os.path.join(cls.test_data_path, 'lyrics.json'), storage=journal.AtomicJSONStorage)
+        cls.original_journal = crud.journal
+        crud.journal = journal.Journal(os.path.join(cls.test_data_path, 'journal.log'))
+        cls.original_thumbnail_path = crud.THUMBNAIL_PATH
+        crud.THUMBNAIL_PATH = os.path.join(cls.test_data_path, 'thumbnails')
         # Create a valid test image
         os.makedirs('images', exist_ok=True)
         with open('images/example.png', 'wb') as f:
@@ -38,6 +53,9 @@ class TestApp(unittest.TestCase):
         """
         Tear down test class by removing test directories and files.
         """
+        crud.journal.close()
+        crud.journal = cls.original_journal
+        crud.THUMBNAIL_PATH = cls.original_thumbnail_path
         if os.path.exists('images'):
             shutil.rmtree('images')
         if os.path.exists(cls.test_data_path):
@@ -48,6 +66,8 @@ class TestApp(unittest.TestCase):
         Set up test case by truncating the test database.
         """
         self.lyrics_db.truncate()
+        crud.last_artefact_ids.clear()
+        stats.get_stats_db(self.lyrics_db).truncate()
 
     def test_create_artefact(self):
         """
@@ -128,7 +148,7 @@ class TestApp(unittest.TestCase):
         role = 'user'
         artefact_id = crud.create_artefact_with_thumbnail(self.lyrics_db, artefact, image_path, category, user, role)
         self.assertEqual(artefact_id, 1)
-        thumbnail_path = os.path.join('data/thumbnails/lyrics', f'{artefact_id}.png')
+        thumbnail_path = os.path.join(crud.THUMBNAIL_PATH, 'lyrics', f'{artefact_id}.png')
         self.assertTrue(os.path.exists(thumbnail_path))
 
     def test_update_artefact_permission(self):
@@ -222,5 +242,398 @@ class TestApp(unittest.TestCase):
         wrong_checksum = 'incorrectchecksum'
         self.assertFalse(crud.verify_checksum(content, wrong_checksum))
 
+    def use_test_keyring(self):
+        """
+        Point crud at a copy of the keyring for the rest of the test.
+
+        Returns:
+            str: The path to the copied keyring.
+        """
+        key_path = os.path.join(self.test_data_path, 'secret.key')
+        shutil.copyfile(crud.KEY_PATH, key_path)
+        original_key_path = crud.KEY_PATH
+        crud.KEY_PATH = key_path
+        crud.load_keys()
+
+        def restore_keyring():
+            crud.KEY_PATH = original_key_path
+            crud.load_keys()
+
+        self.addCleanup(restore_keyring)
+        return key_path
+
+    def test_rotate_key(self):
+        """
+        Test rotating the encryption key and re-encrypting artefacts.
+        """
+        key_path = self.use_test_keyring()
+        old_version = crud.current_key_version
+        for title in ('Song One', 'Song Two', 'Song Three'):
+            crud.create_artefact(self.lyrics_db, {'title': title, 'content': 'La la la'}, 'user1', 'user')
+        checkpoint_path = os.path.join(self.test_data_path, 'rotation_checkpoint.json')
+        rotated = rotation.rotate_key(self.lyrics_db, 'admin1', 'admin', batch_size=2,
+                                      checkpoint_path=checkpoint_path, retire_old_keys=True)
+        self.assertEqual(rotated, 3)
+        self.assertFalse(os.path.exists(checkpoint_path))
+        self.assertEqual(crud.current_key_version, old_version + 1)
+        self.assertEqual([version for version, _ in security.load_keyring(key_path)], [old_version + 1])
+        for artefact in self.lyrics_db.all():
+            self.assertEqual(artefact['key_version'], old_version + 1)
+            self.assertTrue(crud.verify_checksum(artefact['content'], artefact['checksum']))
+        artefacts = crud.read_artefacts(self.lyrics_db, 'user1', 'user')
+        self.assertEqual([artefact['content'] for artefact in artefacts], ['La la la'] * 3)
+
+    def test_rotate_key_resumes_from_checkpoint(self):
+        """
+        Test resuming an interrupted key rotation with the same key.
+        """
+        key_path = self.use_test_keyring()
+        for title in ('Song One', 'Song Two'):
+            crud.create_artefact(self.lyrics_db, {'title': title, 'content': 'La la la'}, 'user1', 'user')
+        new_version = security.add_key(key_path)
+        # The interrupted rotation had rewritten the first artefact
+        crud.update_artefact(self.lyrics_db, 1, {'title': 'Song One', 'content': 'La la la'}, 'user1', 'user')
+        checkpoint_path = os.path.join(self.test_data_path, 'rotation_checkpoint.json')
+        rotation.save_checkpoint({'key_version': new_version, 'last_doc_id': 1, 'rotated': 1}, checkpoint_path)
+        rotated = rotation.rotate_key(self.lyrics_db, 'admin1', 'admin', checkpoint_path=checkpoint_path)
+        self.assertEqual(rotated, 1)
+        self.assertEqual(security.load_keyring(key_path)[0][0], new_version)
+        self.assertEqual(self.lyrics_db.get(doc_id=2)['key_version'], new_version)
+        self.assertEqual(len(crud.read_artefacts(self.lyrics_db, 'user1', 'user')), 2)
+
+    def test_write_uses_key_added_by_another_process(self):
+        """
+        Test that writes pick up a key added to the keyring after it was loaded.
+        """
+        key_path = self.use_test_keyring()
+        new_version = security.add_key(key_path)
+        crud.create_artefact(self.lyrics_db, {'title': 'Test Song', 'content': 'La la la'}, 'user1', 'user')
+        self.assertEqual(self.lyrics_db.get(doc_id=1)['key_version'], new_version)
+
+    def test_rotate_key_keeps_old_keys_in_use(self):
+        """
+        Test that old keys are not retired while an artefact still uses them.
+        """
+        key_path = self.use_test_keyring()
+        crud.create_artefact(self.lyrics_db, {'title': 'Test Song', 'content': 'La la la'}, 'user1', 'user')
+        checkpoint_path = os.path.join(self.test_data_path, 'rotation_checkpoint.json')
+        # Simulate an artefact the rotation passes did not rewrite
+        with mock.patch('rotation._rotate_pending', return_value=0):
+            with self.assertRaises(Exception):
+                rotation.rotate_key(self.lyrics_db, 'admin1', 'admin', checkpoint_path=checkpoint_path,
+                                    retire_old_keys=True)
+        self.assertEqual(len(security.load_keyring(key_path)), 2)
+        self.assertEqual(len(crud.read_artefacts(self.lyrics_db, 'user1', 'user')), 1)
+
+    def test_rotate_key_permission(self):
+        """
+        Test rotating the encryption key with insufficient permissions.
+        """
+        with self.assertRaises(PermissionError):
+            rotation.rotate_key(self.lyrics_db, 'user1', 'user')
+
+    def test_create_after_delete(self):
+        """
+        Test that an artefact created after a delete gets a new ID and keeps the others.
+        """
+        for title in ('Song A', 'Song B'):
+            crud.create_artefact(self.lyrics_db, {'title': title, 'content': 'La la la'}, 'user1', 'user')
+        crud.delete_artefact(self.lyrics_db, 1, 'user1', 'user')
+        artefact_id = crud.create_artefact(self.lyrics_db, {'title': 'Song C', 'content': 'La la la'}, 'user1', 'user')
+        self.assertEqual(artefact_id, 3)
+        artefacts = crud.read_artefacts(self.lyrics_db, 'user1', 'user')
+        self.assertEqual(sorted((artefact['id'], artefact['title']) for artefact in artefacts),
+                         [(2, 'Song B'), (3, 'Song C')])
+
+    def test_journal_replays_committed_transaction(self):
+        """
+        Test that recovery completes a logged transaction and ignores a torn record.
+        """
+        journal_path = os.path.join(self.test_data_path, 'recovery.log')
+        tmp_path, thumbnail_path = crud.get_thumbnail_paths('recovery', 1)
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(b'thumbnail')
+        artefact = {'title': 'Test Song', 'content': 'La la la', 'id': 1}
+        # The insert was applied before the crash, the thumbnail rename was not
+        self.lyrics_db.insert(artefact)
+        record = {'txn': 'a', 'ops': [
+            {'op': 'insert', 'db': self.lyrics_db.storage.path, 'doc_id': 1, 'data': artefact},
+            {'op': 'rename', 'src': tmp_path, 'dst': thumbnail_path}
+        ]}
+        torn = {'txn': 'b', 'ops': [{'op': 'remove', 'db': self.lyrics_db.storage.path, 'doc_id': 1}]}
+        with open(journal_path, 'w', encoding='utf-8') as journal_file:
+            journal_file.write(json.dumps(record) + '\n')
+            journal_file.write(json.dumps(torn)[:30])
+        recovery_journal = journal.Journal(journal_path)
+        self.assertEqual(recovery_journal.recover(), 1)
+        recovery_journal.close()
+        self.assertEqual(self.lyrics_db.all(), [artefact])
+        self.assertFalse(os.path.exists(tmp_path))
+        self.assertTrue(os.path.exists(thumbnail_path))
+        self.assertEqual(os.path.getsize(journal_path), 0)
+
+    def test_main_recovers_before_reading(self):
+        """
+        Test that every command replays a crashed writer's transactions before running.
+        """
+        artefact = {'title': 'Test Song', 'content': 'La la la', 'id': 1}
+        with open(crud.journal.path, 'w', encoding='utf-8') as journal_file:
+            journal_file.write(json.dumps({'txn': 'a', 'ops': [
+                {'op': 'insert', 'db': self.lyrics_db.storage.path, 'doc_id': 1, 'data': artefact}
+            ]}) + '\n')
+        seen = []
+        argv = ['main.py', 'read', '--user', 'user1', '--role', 'user']
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch('main.read_artefacts', side_effect=lambda args: seen.append(self.lyrics_db.all())):
+            main.main()
+        self.assertEqual(seen, [[artefact]])
+
+    def test_storage_keeps_file_mode(self):
+        """
+        Test that atomic writes keep the permissions of the database file.
+        """
+        os.chmod(self.lyrics_db.storage.path, 0o644)
+        self.lyrics_db.insert({'title': 'Test Song'})
+        self.assertEqual(stat.S_IMODE(os.stat(self.lyrics_db.storage.path).st_mode), 0o644)
+
+    def test_create_artefact_syncs_directory_once(self):
+        """
+        Test that the renames of a transaction are flushed by one directory fsync at the checkpoint.
+        """
+        with mock.patch('journal.fsync_path', wraps=journal.fsync_path) as fsync_path:
+            crud.create_artefact(self.lyrics_db, {'title': 'Test Song', 'content': 'La la la'}, 'user1', 'user')
+        fsync_path.assert_called_once_with(os.path.dirname(self.lyrics_db.storage.path))
+        self.assertEqual(os.path.getsize(crud.journal.path), 0)
+
+    def test_journal_lock_flushes_truncation(self):
+        """
+        Test that writes outside the journal start from a durably empty journal.
+        """
+        crud.create_artefact(self.lyrics_db, {'title': 'Test Song', 'content': 'La la la'}, 'user1', 'user')
+        with mock.patch('journal.os.fsync') as fsync:
+            with crud.journal.lock():
+                fsync.assert_called_once_with(crud.journal._file.fileno())
+
+    def test_journal_recovery_waits_for_writer(self):
+        """
+        Test that recovery does not replay a transaction another writer holds the lock for.
+        """
+        journal_path = os.path.join(self.test_data_path, 'shared.log')
+        writer = journal.Journal(journal_path)
+        reader = journal.Journal(journal_path)
+        recovered = []
+        with writer.lock():
+            with open(journal_path, 'a', encoding='utf-8') as journal_file:
+                journal_file.write(json.dumps({'txn': 'a', 'ops': [
+                    {'op': 'insert', 'db': self.lyrics_db.storage.path, 'doc_id': 1, 'data': {'id': 1}}
+                ]}) + '\n')
+            thread = threading.Thread(target=lambda: recovered.append(reader.recover()))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+        thread.join()
+        writer.close()
+        reader.close()
+        self.assertEqual(recovered, [0])
+        self.assertEqual(len(self.lyrics_db), 0)
+
+    def test_create_artefact_with_invalid_thumbnail(self):
+        """
+        Test that a failed thumbnail leaves no artefact behind.
+        """
+        artefact = {
+            'title': 'Test Song',
+            'content': 'La la la'
+        }
+        with self.assertRaises(Exception):
+            crud.create_artefact_with_thumbnail(self.lyrics_db, artefact, 'images/missing.png', 'lyrics', 'user1', 'user')
+        self.assertEqual(len(self.lyrics_db), 0)
+        self.assertFalse(os.path.exists(os.path.join(crud.THUMBNAIL_PATH, 'lyrics', '1.png.tmp')))
+
+    def test_journal_group_commit(self):
+        """
+        Test that concurrent writers share journal fsyncs and apply in journal order.
+        """
+        write_journal = journal.Journal(os.path.join(self.test_data_path, 'group.log'))
+        fsync = os.fsync
+        dumps = json.dumps
+        apply = write_journal._apply
+        journal_fsyncs = []
+        logged = []
+        applied = []
+
+        def slow_fsync(fd):
+            if write_journal._file is not None and fd == write_journal._file.fileno():
+                journal_fsyncs.append(fd)
+                time.sleep(0.02)
+            fsync(fd)
+
+        def log_record(record):
+            logged.append(record['ops'][0]['doc_id'])
+            return dumps(record)
+
+        def apply_record(record, databases):
+            applied.append(record['ops'][0]['doc_id'])
+            apply(record, databases)
+
+        def create(doc_id):
+            with write_journal.transaction() as txn:
+                txn.insert(self.lyrics_db, doc_id, {'title': 'Test Song', 'id': doc_id})
+                txn.update(self.lyrics_db, 1, {'last_writer': doc_id})
+
+        with mock.patch('journal.os.fsync', side_effect=slow_fsync), \
+                mock.patch('journal.json.dumps', side_effect=log_record), \
+                mock.patch.object(write_journal, '_apply', side_effect=apply_record):
+            threads = [threading.Thread(target=create, args=(doc_id,)) for doc_id in range(1, 9)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        log = write_journal._read_records()
+        write_journal.close()
+        self.assertEqual(len(self.lyrics_db), 8)
+        self.assertLess(len(journal_fsyncs), 8)
+        self.assertEqual(log, [])
+        self.assertEqual(applied, logged)
+        self.assertEqual(self.lyrics_db.get(doc_id=1)['last_writer'], logged[-1])
+
+    def test_read_stats(self):
+        """
+        Test that statistics follow creates and deletes.
+        """
+        for user in ('user1', 'user1', 'user2'):
+            crud.create_artefact(self.lyrics_db, {'title': 'Test Song', 'content': 'La la la'}, user, 'user')
+        crud.delete_artefact(self.lyrics_db, 3, 'user2', 'user')
+        today = datetime.now().strftime('%Y-%m-%d')
+        summary = crud.read_stats(self.lyrics_db, 'user1', 'user')
+        self.assertEqual(summary, {
+            'category': 'lyrics',
+            'total': 2,
+            'by_creator': {'user1': 2},
+            'by_day': {today: 2}
+        })
+
+    def test_read_stats_date_range(self):
+        """
+        Test counting artefacts created in a range of days.
+        """
+        crud.create_artefact(self.lyrics_db, {'title': 'Test Song', 'content': 'La la la'}, 'user1', 'user')
+        artefact_id = crud.create_artefact(self.lyrics_db, {'title': 'Old Song', 'content': 'La la la'}, 'user2', 'user')
+        crud.update_artefact(self.lyrics_db, artefact_id, {'title': 'Old Song', 'content': 'La la la',
+                                                           'created_at': '2020-01-15T10:00:00'}, 'user2', 'user')
+        month = datetime.now().strftime('%Y-%m')
+        summary = crud.read_stats(self.lyrics_db, 'user1', 'user', since=month + '-01', until=month + '-31')
+        self.assertEqual(summary['total'], 1)
+        self.assertEqual(summary['by_creator'], {'user1': 1})
+        summary = crud.read_stats(self.lyrics_db, 'user1', 'user', until='2020-12-31')
+        self.assertEqual(summary['by_creator'], {'user2': 1})
+        self.assertEqual(summary['by_day'], {'2020-01-15': 1})
+
+    def test_rebuild_stats(self):
+        """
+        Test rebuilding statistics from the stored artefacts.
+        """
+        crud.create_artefact(self.lyrics_db, {'title': 'Test Song', 'content': 'La la la'}, 'user1', 'user')
+        stats.get_stats_db(self.lyrics_db).truncate()
+        self.assertEqual(crud.read_stats(self.lyrics_db, 'user1', 'user')['total'], 0)
+        with mock.patch('crud.decrypt') as decrypt:
+            summary = crud.read_stats(self.lyrics_db, 'admin1', 'admin', rebuild=True)
+        decrypt.assert_not_called()
+        self.assertEqual(summary['total'], 1)
+        self.assertEqual(summary['by_creator'], {'user1': 1})
+        self.assertNotIn('_txn', summary)
+
+    def test_rebuild_stats_permission(self):
+        """
+        Test rebuilding statistics with insufficient permissions.
+        """
+        with self.assertRaises(PermissionError):
+            crud.read_stats(self.lyrics_db, 'user1', 'user', rebuild=True)
+
+    def test_stats_count_artefacts_stored_before_stats(self):
+        """
+        Test that the first write counts the artefacts stored before statistics existed.
+        """
+        for title in ('Song One', 'Song Two', 'Song Three'):
+            crud.create_artefact(self.lyrics_db, {'title': title, 'content': 'La la la'}, 'user1', 'user')
+        stats.get_stats_db(self.lyrics_db).truncate()
+        crud.delete_artefact(self.lyrics_db, 1, 'user1', 'user')
+        summary = crud.read_stats(self.lyrics_db, 'user1', 'user')
+        self.assertEqual(summary['total'], 2)
+        self.assertEqual(summary['by_creator'], {'user1': 2})
+
+    def test_concurrent_deletes_count_once(self):
+        """
+        Test that threads deleting the same artefact uncount it once.
+        """
+        crud.create_artefact(self.lyrics_db, {'title': 'Song One', 'content': 'La la la'}, 'user1', 'user')
+        crud.create_artefact(self.lyrics_db, {'title': 'Song Two', 'content': 'La la la'}, 'user2', 'user')
+        fsync = os.fsync
+
+        def slow_fsync(fd):
+            time.sleep(0.02)
+            fsync(fd)
+
+        with mock.patch('journal.os.fsync', side_effect=slow_fsync):
+            threads = [threading.Thread(target=crud.delete_artefact, args=(self.lyrics_db, 2, 'user2', 'user'))
+                       for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        summary = crud.read_stats(self.lyrics_db, 'user1', 'user')
+        self.assertEqual(summary['total'], 1)
+        self.assertEqual(summary['by_creator'], {'user1': 1})
+
+    def test_parse_day(self):
+        """
+        Test that statistics days are validated and zero padded.
+        """
+        self.assertEqual(main.parse_day('2024-6-1'), '2024-06-01')
+        with self.assertRaises(argparse.ArgumentTypeError):
+            main.parse_day('2024-13-01')
+
+    def test_read_stats_skips_artefacts(self):
+        """
+        Test that reading statistics does not read the artefact database.
+        """
+        crud.create_artefact(self.lyrics_db, {'title': 'Test Song', 'content': 'La la la'}, 'user1', 'user')
+        self.lyrics_db.clear_cache()
+        with mock.patch.object(self.lyrics_db.storage, 'read', side_effect=AssertionError("lyrics.json read")):
+            summary = crud.read_stats(self.lyrics_db, 'user1', 'user')
+        self.assertEqual(summary['total'], 1)
+
+    def test_journal_replay_counts_once(self):
+        """
+        Test that replaying counter increments skips those already applied.
+        """
+        crud.create_artefact(self.lyrics_db, {'title': 'Test Song', 'content': 'La la la'}, 'user1', 'user')
+        stats_db = stats.get_stats_db(self.lyrics_db)
+        first = stats.load_counters(self.lyrics_db)['_txn']
+        artefact = dict(self.lyrics_db.get(doc_id=1))
+        second = dict(artefact, id=2)
+        journal_path = os.path.join(self.test_data_path, 'replay.log')
+        with open(journal_path, 'w', encoding='utf-8') as journal_file:
+            for txn, doc_id, data in ((first, 1, artefact), ('second', 2, second)):
+                journal_file.write(json.dumps({'txn': txn, 'ops': [
+                    {'op': 'insert', 'db': self.lyrics_db.storage.path, 'doc_id': doc_id, 'data': data},
+                    {'op': 'fold', 'db': stats_db.storage.path, 'key': {'category': 'lyrics'},
+                     'fold': stats.COUNTERS_FOLD, 'data': {'counters': None, 'deltas': [
+                         [path, delta] for path, delta in stats.get_deltas(data, 1)]}}
+                ]}) + '\n')
+        replay_journal = journal.Journal(journal_path)
+        self.assertEqual(replay_journal.recover(), 2)
+        replay_journal.close()
+        stats_db.clear_cache()
+        self.assertEqual(len(self.lyrics_db), 2)
+        self.assertEqual(crud.read_stats(self.lyrics_db, 'user1', 'user')['total'], 2)
+
+    def test_read_stats_invalid_role(self):
+        """
+        Test reading statistics with an invalid role.
+        """
+        with self.assertRaises(ValueError):
+            crud.read_stats(self.lyrics_db, 'user1', 'invalid_role')
+
 if __name__ == '__main__':
     unittest.main()